@@ -1,77 +1,223 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
+import duckdb
 from datetime import datetime, timedelta
-import matplotlib.pyplot as plt
 import os
 from streamlit_autorefresh import st_autorefresh
 
-# Auto-refresh every 60 seconds (10,000 ms)
-st_autorefresh(interval=30 * 1000, limit=None, key="datarefresh")
 st.set_page_config(page_title="Sales & Inventory Dashboard", layout="wide")
 
+# Auto-refresh every 30 seconds (30,000 ms), only when asked for so idle dashboards don't rerun
+if st.sidebar.checkbox("Auto-refresh every 30s", value=False):
+    st_autorefresh(interval=30 * 1000, limit=None, key="datarefresh")
+
 
 
 # Get the directory where this script is located
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
 # Build file paths relative to the script's directory
-INVENTORY_FILE = os.path.join(script_dir, "inventory.xlsx")
-SALES_FILE = os.path.join(script_dir, "sales_log.csv")
+INVENTORY_FILE = os.path.join(script_dir, "inventory.parquet")
+INVENTORY_XLSX_FILE = os.path.join(script_dir, "inventory.xlsx")
+SALES_DIR = os.path.join(script_dir, "sales_log")
+SALES_CSV_FILE = os.path.join(script_dir, "sales_log.csv")
 
 
 
 
 @st.cache_data(ttl=10)
-def load_inventory():
-    df = pd.read_excel(INVENTORY_FILE, dtype={"barcode": str})
+def load_inventory(inventory_mtime):
+    # The till keeps the inventory in Parquet; fall back to the spreadsheet until it has run
+    if os.path.exists(INVENTORY_FILE):
+        df = pd.read_parquet(INVENTORY_FILE)
+    else:
+        df = pd.read_excel(INVENTORY_XLSX_FILE, dtype={"barcode": str})
     df.columns = df.columns.str.strip()
+    # Sales are joined to the inventory by barcode (a LEFT JOIN in DuckDB), so a duplicate barcode
+    # would repeat sales rows and inflate every figure
+    duplicated = df["barcode"].duplicated()
+    if duplicated.any():
+        raise ValueError(f"Duplicate barcodes in inventory: {', '.join(df.loc[duplicated, 'barcode'].astype(str).unique())}")
+    # Boolean mask and categorical dtypes for the low-cardinality text columns
+    df["is_active"] = df["is_active"].fillna(False).astype(bool)
+    for col in ("category", "brand", "supplier"):
+        df[col] = df[col].astype("category")
     return df
 
-@st.cache_data(ttl=10)
-def load_sales():
-    df = pd.read_csv(SALES_FILE, dtype={"barcode": str})
-    df.columns = df.columns.str.strip()
-    df['timestamp'] = pd.to_datetime(df['timestamp'])
-    df['discount'] = df.get('discount', 0).fillna(0)
-    return df
+def data_mtimes():
+    # Modification times of the inventory and sales data, used as cache keys
+    inventory_path = INVENTORY_FILE if os.path.exists(INVENTORY_FILE) else INVENTORY_XLSX_FILE
+    if os.path.isdir(SALES_DIR):
+        # A sale adds a file to its day partition, which bumps that partition directory's mtime
+        with os.scandir(SALES_DIR) as partitions:
+            sales_mtime = max([os.path.getmtime(SALES_DIR)] + [p.stat().st_mtime for p in partitions])
+    else:
+        sales_mtime = os.path.getmtime(SALES_CSV_FILE)
+    return os.path.getmtime(inventory_path), sales_mtime
+
+def sales_source():
+    # DuckDB table expression for the sales log: the till's day-partitioned Parquet dataset,
+    # or the old CSV log until the till has migrated it
+    if os.path.isdir(SALES_DIR):
+        pattern = os.path.join(SALES_DIR, "*", "*.parquet").replace("'", "''")
+        return f"read_parquet('{pattern}', hive_partitioning = true, hive_types = {{'date': VARCHAR}})"
+    path = SALES_CSV_FILE.replace("'", "''")
+    return (
+        f"(SELECT *, strftime(timestamp, '%Y-%m-%d') AS date FROM read_csv('{path}', "
+        f"types = {{'barcode': 'VARCHAR', 'membership_id': 'VARCHAR', 'timestamp': 'TIMESTAMP'}}))"
+    )
 
-inventory_df = load_inventory()
-sales_df = load_sales()
+def run_sql(sql, params=None, **frames):
+    # Run a query in a fresh in-memory DuckDB connection, with the given DataFrames registered as tables
+    with duckdb.connect() as con:
+        for name, df in frames.items():
+            con.register(name, df)
+        return con.execute(sql, params).df()
 
-# Merge sales with inventory
-sales_merged = sales_df.merge(
-    inventory_df[['barcode', 'category', 'brand', 'supplier', 'cost_price', 'name', 'stock_qty', 'reorder_level']],
-    on='barcode',
-    how='left',
-    suffixes=('', '_inv')
-)
+@st.cache_data(ttl=10)
+def load_filter_options(inventory_mtime, sales_mtime):
+    options = run_sql(
+        f"""
+        SELECT max(s.timestamp) AS max_timestamp,
+               list_sort(list(DISTINCT s.category) FILTER (WHERE s.category IS NOT NULL)) AS categories,
+               list_sort(list(DISTINCT i.brand::VARCHAR) FILTER (WHERE i.brand IS NOT NULL)) AS brands
+        FROM {sales_source()} s
+        LEFT JOIN inventory i ON s.barcode = i.barcode
+        """,
+        inventory=load_inventory(inventory_mtime),
+    ).iloc[0]
+    return options['max_timestamp'], list(options['categories']), list(options['brands'])
+
+data_version = data_mtimes()
+inventory_df = load_inventory(data_version[0])
+max_timestamp, all_categories, all_brands = load_filter_options(*data_version)
 
 # Sidebar filters
 st.sidebar.header("Filters")
-max_date = sales_merged['timestamp'].max().date()
+max_date = max_timestamp.date()
 min_date = max_date - timedelta(days=90)
 date_range = st.sidebar.date_input("Date range", [min_date, max_date], min_value=min_date, max_value=max_date)
 
-all_categories = sorted(sales_merged['category'].dropna().unique())
 selected_categories = st.sidebar.multiselect("Category", options=all_categories, default=all_categories)
 
-all_brands = sorted(sales_merged['brand'].dropna().unique())
 selected_brands = st.sidebar.multiselect("Brand", options=all_brands, default=all_brands)
 
-sales_filtered = sales_merged[
-    (sales_merged['timestamp'].dt.date >= date_range[0]) &
-    (sales_merged['timestamp'].dt.date <= date_range[1]) &
-    (sales_merged['category'].isin(selected_categories)) &
-    (sales_merged['brand'].isin(selected_brands))
-]
+@st.cache_data(max_entries=10)
+def filter_sales(data_version, date_range, categories, brands):
+    # Filtering and the inventory join run in DuckDB; the date bounds skip whole day partitions,
+    # the timestamp bounds are exact (end is exclusive, the day after)
+    start = pd.Timestamp(date_range[0])
+    end = pd.Timestamp(date_range[1]) + pd.Timedelta(days=1)
+    sales_filtered = run_sql(
+        f"""
+        SELECT s.sale_id, s.timestamp, s.membership_id, s.barcode, s.product_name, s.category,
+               s.qty, s.unit_price, s.line_total, coalesce(s.discount, 0) AS discount,
+               i.category::VARCHAR AS category_inv, i.brand::VARCHAR AS brand, i.supplier::VARCHAR AS supplier,
+               i.cost_price, i.name, i.stock_qty, i.reorder_level,
+               i.cost_price * s.qty AS cost, s.line_total - i.cost_price * s.qty AS profit
+        FROM {sales_source()} s
+        LEFT JOIN inventory i ON s.barcode = i.barcode
+        WHERE s.date BETWEEN ? AND ?
+          AND s.timestamp >= ? AND s.timestamp < ?
+          AND list_contains(?::VARCHAR[], s.category)
+          AND list_contains(?::VARCHAR[], i.brand::VARCHAR)
+        ORDER BY s.timestamp
+        """,
+        [date_range[0].isoformat(), date_range[1].isoformat(), start, end, list(categories), list(brands)],
+        inventory=load_inventory(data_version[0]),
+    )
+    sales_filtered['month'] = sales_filtered['timestamp'].dt.to_period('M')
+    return sales_filtered
+
+def count_distinct(keys, values):
+    # Distinct values per key without a per-group lambda: encode each (key, value) pair as one int64,
+    # keep the unique pairs and count them per key
+    key_codes, key_uniques = pd.factorize(keys, sort=True)
+    value_codes, value_uniques = pd.factorize(values)
+    valid = (key_codes >= 0) & (value_codes >= 0)
+    n_values = max(len(value_uniques), 1)
+    pairs = np.unique(key_codes[valid].astype(np.int64) * n_values + value_codes[valid])
+    return pd.Series(np.bincount(pairs // n_values, minlength=len(key_uniques)), index=key_uniques)
+
+@st.cache_data(max_entries=10)
+def compute_product_stats(sales_filtered, days_in_range):
+    sale_days = sales_filtered['timestamp'].to_numpy().astype('datetime64[D]')
+    product_stats = sales_filtered.groupby('product_name').agg(
+        total_units=('qty', 'sum'),
+        total_sales=('line_total', 'sum')
+    ).assign(days_sold=count_distinct(sales_filtered['product_name'], sale_days)).reset_index()
+
+    product_stats['avg_units_per_day'] = product_stats['total_units'] / days_in_range
+    product_stats['sales_frequency_pct'] = product_stats['days_sold'] / days_in_range * 100
+    product_stats['avg_sales_per_day'] = product_stats['total_sales'] / days_in_range
+
+    return product_stats.sort_values('total_units', ascending=False)
+
+@st.cache_data(max_entries=10)
+def compute_reorder_levels(inventory_df, sales_filtered):
+    monthly_sales_per_product = sales_filtered.groupby(['barcode', 'month'], observed=True)['qty'].sum().groupby('barcode', observed=True).mean()
+
+    # Two months of average sales, rounded up, with a floor of 5
+    reorder_levels = np.maximum(np.ceil(monthly_sales_per_product.to_numpy() * 2).astype(np.int64), 5)
+    reorder_levels = pd.Series(reorder_levels, index=monthly_sales_per_product.index, name='dynamic_reorder_level').reset_index()
+
+    inventory_with_reorder = inventory_df.merge(reorder_levels, on='barcode', how='left')
+    inventory_with_reorder['reorder_level'] = inventory_with_reorder['reorder_level'].fillna(
+        inventory_with_reorder['dynamic_reorder_level']
+    ).fillna(5)
+    return monthly_sales_per_product, inventory_with_reorder
+
+@st.cache_data(max_entries=10)
+def compute_breakdowns(sales_filtered):
+    # Grouped aggregates run in DuckDB over the filtered sales
+    tables = {"sales_filtered": sales_filtered.drop(columns="month")}
+
+    # Sales by category / brand
+    sales_by_category = run_sql("""
+        SELECT category, sum(line_total) AS total_sales, sum(qty)::BIGINT AS units_sold,
+               avg(discount) AS avg_discount, coalesce(sum(profit), 0) AS profit
+        FROM sales_filtered WHERE category IS NOT NULL
+        GROUP BY category ORDER BY total_sales DESC
+    """, **tables).set_index('category')
+
+    sales_by_brand = run_sql("""
+        SELECT brand, sum(line_total) AS total_sales, sum(qty)::BIGINT AS units_sold,
+               avg(discount) AS avg_discount, coalesce(sum(profit), 0) AS profit
+        FROM sales_filtered WHERE brand IS NOT NULL
+        GROUP BY brand ORDER BY total_sales DESC
+    """, **tables).set_index('brand')
+
+    # Membership / discount impact
+    membership_sales = run_sql("""
+        SELECT membership_id, sum(line_total) AS total_sales, sum(qty)::BIGINT AS units_sold,
+               avg(discount) AS avg_discount, count(DISTINCT sale_id) AS count_sales
+        FROM sales_filtered WHERE membership_id IS NOT NULL
+        GROUP BY membership_id ORDER BY total_sales DESC
+    """, **tables).set_index('membership_id')
+
+    discount_impact = run_sql("""
+        SELECT category, avg(discount) AS avg_discount, sum(line_total) AS total_sales
+        FROM sales_filtered WHERE category IS NOT NULL
+        GROUP BY category ORDER BY avg_discount DESC
+    """, **tables).set_index('category')
+
+    monthly_sales = run_sql("""
+        SELECT date_trunc('month', timestamp) AS timestamp, sum(line_total) AS total_sales,
+               sum(qty)::BIGINT AS units_sold
+        FROM sales_filtered
+        GROUP BY ALL ORDER BY ALL
+    """, **tables)
+    return sales_by_category, sales_by_brand, membership_sales, discount_impact, monthly_sales
+
+# Each stage is cached on its inputs, so widget interactions that change nothing recompute nothing
+sales_filtered = filter_sales(data_version, tuple(date_range), selected_categories, selected_brands)
 
 # KPI calculations
 total_sales = sales_filtered['line_total'].sum()
 total_units = sales_filtered['qty'].sum()
 avg_discount = sales_filtered['discount'].mean()
 
-sales_filtered['cost'] = sales_filtered['cost_price'] * sales_filtered['qty']
 total_cost = sales_filtered['cost'].sum()
 total_profit = total_sales - total_cost
 
@@ -80,68 +226,13 @@ days_in_range = (date_range[1] - date_range[0]).days + 1
 avg_units_per_day_global = total_units / days_in_range if days_in_range > 0 else 0
 
 # Per product stats
-product_stats = sales_filtered.groupby('product_name').agg(
-    total_units=('qty', 'sum'),
-    total_sales=('line_total', 'sum'),
-    days_sold=('timestamp', lambda x: x.dt.date.nunique())
-).reset_index()
-
-product_stats['avg_units_per_day'] = product_stats['total_units'] / days_in_range
-product_stats['sales_frequency_pct'] = product_stats['days_sold'] / days_in_range * 100
-product_stats['avg_sales_per_day'] = product_stats['total_sales'] / days_in_range
-
-product_stats = product_stats.sort_values('total_units', ascending=False)
+product_stats = compute_product_stats(sales_filtered, days_in_range)
 
 # Reorder / low stock logic
-sales_filtered['month'] = sales_filtered['timestamp'].dt.to_period('M')
-monthly_sales_per_product = sales_filtered.groupby(['barcode', 'month'])['qty'].sum().groupby('barcode').mean()
-
-reorder_levels = monthly_sales_per_product.apply(lambda x: max(int(np.ceil(x * 2)), 5))
-reorder_levels = reorder_levels.rename('dynamic_reorder_level').reset_index()
-
-inventory_with_reorder = inventory_df.merge(reorder_levels, on='barcode', how='left')
-inventory_with_reorder['reorder_level'] = inventory_with_reorder['reorder_level'].fillna(
-    inventory_with_reorder['dynamic_reorder_level']
-).fillna(5)
-
+monthly_sales_per_product, inventory_with_reorder = compute_reorder_levels(inventory_df, sales_filtered)
 low_stock_df = inventory_with_reorder[inventory_with_reorder['stock_qty'] <= inventory_with_reorder['reorder_level']]
 
-# Sales by category / brand
-def calc_profit(df):
-    return (df['line_total'] - df['cost_price'] * df['qty']).sum()
-
-sales_by_category = sales_filtered.groupby('category').agg(
-    total_sales=('line_total', 'sum'),
-    units_sold=('qty', 'sum'),
-    avg_discount=('discount', 'mean'),
-    profit=('qty', lambda x: calc_profit(sales_filtered.loc[x.index]))
-).sort_values('total_sales', ascending=False)
-
-sales_by_brand = sales_filtered.groupby('brand').agg(
-    total_sales=('line_total', 'sum'),
-    units_sold=('qty', 'sum'),
-    avg_discount=('discount', 'mean'),
-    profit=('qty', lambda x: calc_profit(sales_filtered.loc[x.index]))
-).sort_values('total_sales', ascending=False)
-
-# Membership / discount impact
-membership_sales = sales_filtered.groupby('membership_id').agg(
-    total_sales=('line_total', 'sum'),
-    units_sold=('qty', 'sum'),
-    avg_discount=('discount', 'mean'),
-    count_sales=('sale_id', 'nunique')
-).sort_values('total_sales', ascending=False)
-
-discount_impact = sales_filtered.groupby('category').agg(
-    avg_discount=('discount', 'mean'),
-    total_sales=('line_total', 'sum')
-).sort_values('avg_discount', ascending=False)
-
-monthly_sales = sales_filtered.groupby(sales_filtered['timestamp'].dt.to_period('M')).agg(
-    total_sales=('line_total', 'sum'),
-    units_sold=('qty', 'sum')
-).reset_index()
-monthly_sales['timestamp'] = monthly_sales['timestamp'].dt.to_timestamp()
+sales_by_category, sales_by_brand, membership_sales, discount_impact, monthly_sales = compute_breakdowns(sales_filtered)
 
 # Tab logic with session_state to preserve tab across refresh
 tabs = [
@@ -180,7 +271,7 @@ if sel == "Summary KPIs":
     c6, c7, c8, c9, c10 = st.columns(5)
     c6.metric("Avg Units/Day", f"{avg_units_per_day_global:.2f}")
     c7.metric("Low Stock Count", f"{len(low_stock_df)}")
-    c8.metric("Active Products", f"{inventory_df[inventory_df['is_active'] == True]['barcode'].nunique()}")
+    c8.metric("Active Products", f"{inventory_df.loc[inventory_df['is_active'].to_numpy(), 'barcode'].nunique()}")
     c9.metric("Unique Customers", f"{sales_filtered['membership_id'].nunique()}")
     c10.metric("Avg Sale Value (R)", f"R {total_sales / max(1, sales_filtered['sale_id'].nunique()):,.2f}")
 
@@ -195,6 +286,9 @@ elif sel == "Sales Analysis":
     st.line_chart(monthly_sales.set_index('timestamp')['total_sales'])
 
 elif sel == "Top Products":
+    # Only this tab plots with matplotlib, so don't pay for the import on every rerun
+    import matplotlib.pyplot as plt
+
     st.header("Top Products with Averages")
     num_top = st.slider("Show top N products", min_value=5, max_value=50, value=10)
     top_subset = product_stats.head(num_top)
@@ -235,7 +329,7 @@ elif sel == "Inventory Status":
 
         # Calculate reorder qty based on 2 months average sales minus current stock
         low_stock_df['avg_monthly_sales'] = avg_monthly_sales.values
-        low_stock_df['reorder_qty'] = (2 * low_stock_df['avg_monthly_sales'] - low_stock_df['stock_qty']).apply(lambda x: max(x, 0)).astype(int)
+        low_stock_df['reorder_qty'] = (2 * low_stock_df['avg_monthly_sales'] - low_stock_df['stock_qty']).clip(lower=0).astype(int)
 
         st.subheader("Low-stock Items (with reorder quantities)")
         st.dataframe(
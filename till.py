@@ -1,35 +1,170 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import uuid
 from datetime import datetime
-import csv
+import atexit
+import io
+import logging
 import os
+import shutil
+import tempfile
+import threading
+import time
+
+import till_state
 
 
 # Get the directory where this script is located
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
 # Build file paths relative to the script's directory
-INVENTORY_FILE = os.path.join(script_dir,"inventory.xlsx")
-SALES_FILE = os.path.join(script_dir, "sales_log.csv")
+INVENTORY_FILE = os.path.join(script_dir, "inventory.parquet")
+INVENTORY_XLSX_FILE = os.path.join(script_dir, "inventory.xlsx")
+SALES_DIR = os.path.join(script_dir, "sales_log")
+SALES_CSV_FILE = os.path.join(script_dir, "sales_log.csv")
+
+# Minimum seconds between inventory writes; stock changes in between are buffered in memory
+# and written by a timer once the interval has passed
+INVENTORY_FLUSH_INTERVAL = 30
+
+# Fixed schema so every appended file in the sales dataset lines up
+SALES_SCHEMA = pa.schema([
+    ("sale_id", pa.string()),
+    ("timestamp", pa.timestamp("us")),
+    ("membership_id", pa.string()),
+    ("barcode", pa.string()),
+    ("product_name", pa.string()),
+    ("category", pa.string()),
+    ("qty", pa.int64()),
+    ("unit_price", pa.float64()),
+    ("line_total", pa.float64()),
+    ("discount", pa.float64()),
+    ("date", pa.string()),
+])
 
 # --- Load inventory
+def read_inventory():
+    # Seed the Parquet store from the spreadsheet on first run
+    if not os.path.exists(INVENTORY_FILE):
+        seed_df = pd.read_excel(INVENTORY_XLSX_FILE, dtype={"barcode": str})
+        seed_df.to_parquet(INVENTORY_FILE, index=False, compression="zstd")
+
+    df = pd.read_parquet(INVENTORY_FILE)
+    df.columns = df.columns.str.strip()
+
+    # Ensure reorder_level column exists, else add default 10
+    if "reorder_level" not in df.columns:
+        df["reorder_level"] = 10
+
+    # Boolean mask and categorical dtypes for the low-cardinality text columns
+    df["is_active"] = df["is_active"].fillna(False).astype(bool)
+    for col in ("category", "brand", "supplier"):
+        df[col] = df[col].astype("category")
+    df = df.loc[df["is_active"].to_numpy()]
+
+    # Index by barcode (keeping the column) so lookups and stock updates are label lookups, not scans
+    return df.set_index("barcode", drop=False)
+
+def inventory_mtime():
+    return os.path.getmtime(INVENTORY_FILE) if os.path.exists(INVENTORY_FILE) else None
+
+def deduct_stock(df, barcodes, qtys):
+    # Subtract sold quantities by row position via the index hash table, never going below zero
+    positions = df.index.get_indexer(barcodes)
+    found = positions >= 0
+    stock = df["stock_qty"].to_numpy(copy=True)
+    np.subtract.at(stock, positions[found], np.asarray(qtys, dtype=np.int64)[found])
+    np.maximum(stock, 0, out=stock)
+    df["stock_qty"] = stock
+
+def load_inventory_state(state):
+    # (Re)read the inventory file and re-apply the stock sold since the last flush ("pending"),
+    # so edits made to the file outside the till are picked up without losing unsaved sales
+    df = read_inventory()
+    if state["pending"]:
+        deduct_stock(df, list(state["pending"]), list(state["pending"].values()))
+    state["df"] = df
+    state["mtime"] = inventory_mtime()
+
+def inventory_state():
+    # Shared by all sessions and kept in till_state rather than st.cache_resource, so "Clear cache"
+    # can't discard stock changes that haven't been written to INVENTORY_FILE yet
+    with till_state.lock:
+        state = till_state.inventories.get(INVENTORY_FILE)
+        if state is None:
+            state = {"pending": {}, "last_flush": 0.0, "timer": None}
+            load_inventory_state(state)
+            till_state.inventories[INVENTORY_FILE] = state
+            atexit.register(flush_inventory_in_background)
+        elif inventory_mtime() != state["mtime"]:
+            load_inventory_state(state)
+        return state
+
+def current_inventory():
+    # Callbacks run with the previous rerun's globals, so helpers look up the live frame on each
+    # call instead of using the module-level inventory_df, which may have been reloaded since
+    return inventory_state()["df"]
+
+def write_inventory(force=False):
+    with till_state.lock:
+        # Reloads first if the file changed on disk, so the write merges into the newer file
+        state = inventory_state()
+        if not state["pending"]:
+            return
+        if not force and time.monotonic() - state["last_flush"] < INVENTORY_FLUSH_INTERVAL:
+            return
+
+        # Save inventory back to the Parquet file
+        state["df"].to_parquet(INVENTORY_FILE, index=False, compression="zstd")
+        state["pending"].clear()
+        state["mtime"] = inventory_mtime()
+        state["last_flush"] = time.monotonic()
+
+def flush_inventory(force=False):
+    try:
+        write_inventory(force)
+    except Exception as e:
+        st.error(f"Failed to save updated inventory: {e}")
+
+def flush_inventory_in_background():
+    # Runs from the flush timer or at interpreter exit, outside any script run, so failures go to
+    # the server log instead of the page
+    with till_state.lock:
+        inventory_state()["timer"] = None
+    try:
+        write_inventory(force=True)
+    except Exception:
+        logging.getLogger(__name__).exception("Failed to save updated inventory")
+
+def schedule_flush():
+    # Write out buffered sales once the flush interval has passed even if nobody uses the till
+    # again, so the file (and the dashboard) doesn't lag behind the sales log
+    with till_state.lock:
+        state = inventory_state()
+        if not state["pending"] or state["timer"] is not None:
+            return
+        delay = max(0.0, INVENTORY_FLUSH_INTERVAL - (time.monotonic() - state["last_flush"]))
+        state["timer"] = threading.Timer(delay, flush_inventory_in_background)
+        state["timer"].daemon = True
+        state["timer"].start()
+
 try:
-    inventory_df = pd.read_excel(INVENTORY_FILE, dtype={"barcode": str})
+    inventory_df = inventory_state()["df"]
 except FileNotFoundError:
-    st.error(f"Inventory file not found at: {INVENTORY_FILE}")
+    st.error(f"Inventory file not found at: {INVENTORY_XLSX_FILE}")
     st.stop()
 
-inventory_df.columns = inventory_df.columns.str.strip()
-
-# Ensure reorder_level column exists, else add default 10
-if "reorder_level" not in inventory_df.columns:
-    inventory_df["reorder_level"] = 10
-
-inventory_df = inventory_df[inventory_df["is_active"] == True]
+@st.cache_resource(max_entries=1)
+def build_name_index(inventory_mtime):
+    # Only a cache key: the index is rebuilt when the inventory file changes, not on every rerun
+    df = current_inventory()
+    return dict(zip(df["name"], df["barcode"])), [""] + df["name"].tolist()
 
-# Make PRODUCTS dict from inventory_df
-PRODUCTS = inventory_df.set_index("barcode").to_dict(orient="index")
+# Write out stock changes buffered by earlier checkouts once the flush interval has passed
+flush_inventory()
 
 # --- Session state
 if "cart" not in st.session_state:
@@ -44,133 +179,195 @@ if "discount" not in st.session_state:
     st.session_state.discount = 0
 if "discount_type" not in st.session_state:
     st.session_state.discount_type = "percent"
+if "cart_version" not in st.session_state:
+    st.session_state.cart_version = 0
+
+# --- Sales log helpers
+def append_sales(sales_df, root_path=SALES_DIR):
+    # Each call adds one file under the sale day's partition, e.g. sales_log/date=2025-09-19/
+    sales_df = sales_df.assign(date=sales_df["timestamp"].dt.strftime("%Y-%m-%d"))
+    table = pa.Table.from_pandas(sales_df, schema=SALES_SCHEMA, preserve_index=False)
+    pq.write_to_dataset(table, root_path=root_path, partition_cols=["date"])
+
+def ensure_sales_log():
+    # Checked again under the lock so sessions starting together import the old CSV log only once
+    with till_state.lock:
+        if os.path.isdir(SALES_DIR):
+            return
+        if not os.path.exists(SALES_CSV_FILE):
+            os.makedirs(SALES_DIR, exist_ok=True)
+            return
 
-# --- Ensure sales log exists
-if not os.path.exists(SALES_FILE):
-    with open(SALES_FILE, "w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow([
-            "sale_id", "timestamp", "membership_id", "barcode", "product_name",
-            "category", "qty", "unit_price", "line_total", "discount"
-        ])
+        # Build the dataset beside SALES_DIR and move it into place in one step, so a crash
+        # part-way leaves no SALES_DIR and the migration simply runs again next time
+        tmp_dir = tempfile.mkdtemp(dir=script_dir, prefix=".sales_log-")
+        try:
+            legacy_df = pd.read_csv(SALES_CSV_FILE, dtype={"barcode": str, "membership_id": str})
+            legacy_df["timestamp"] = pd.to_datetime(legacy_df["timestamp"])
+            append_sales(legacy_df, root_path=tmp_dir)
+            os.replace(tmp_dir, SALES_DIR)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+# --- Ensure sales log exists, migrating the old CSV log on first run
+ensure_sales_log()
 
 # --- Helper functions
 def add_to_cart(barcode, qty=1):
-    product = PRODUCTS.get(barcode)
-    if not product:
+    inventory_df = current_inventory()
+    if barcode not in inventory_df.index:
         st.warning(f"Barcode {barcode} not found in inventory")
         return
-    
+    name = inventory_df.at[barcode, "name"]
+
     # Check stock availability
-    current_stock = product.get("stock_qty", 0)
+    current_stock = inventory_df.at[barcode, "stock_qty"]
     if qty > current_stock:
-        st.warning(f"Not enough stock for {product['name']}. Available: {current_stock}")
+        st.warning(f"Not enough stock for {name}. Available: {current_stock}")
         return
 
     for line in st.session_state.cart:
         if line["barcode"] == barcode:
             if line["qty"] + qty > current_stock:
-                st.warning(f"Cannot add {qty} more {product['name']}. Only {current_stock - line['qty']} left in stock.")
+                st.warning(f"Cannot add {qty} more {name}. Only {current_stock - line['qty']} left in stock.")
                 return
             line["qty"] += qty
             return
-    line = {
-        "id": str(uuid.uuid4()),
-        "barcode": barcode,
-        "name": product["name"],
-        "qty": qty,
-        "unit_price": product["price"],
-        "category": product["category"],
-        "pack_size": product.get("pack_size", ""),
-    }
-    st.session_state.cart.append(line)
-
-def remove_one_from_cart(line_id):
-    for line in st.session_state.cart:
-        if line["id"] == line_id:
-            if line["qty"] > 1:
-                line["qty"] -= 1
-            else:
-                st.session_state.cart = [l for l in st.session_state.cart if l["id"] != line_id]
-            break
-
-def calc_totals():
-    subtotal = sum(line["unit_price"] * line["qty"] for line in st.session_state.cart)
-    
+    # Product details are looked up from the inventory when needed (see cart_details)
+    st.session_state.cart.append({"barcode": barcode, "qty": qty})
+
+def cart_details(cart):
+    # Join cart lines with their current product details; unknown barcodes get NaN details
+    inventory_df = current_inventory()
+    cart_df = pd.DataFrame(cart, columns=["barcode", "qty"])
+    product_cols = inventory_df[["name", "price", "category", "pack_size", "stock_qty", "reorder_level"]]
+    return cart_df.join(product_cols.rename(columns={"price": "unit_price"}), on="barcode")
+
+def apply_cart_edits(editor_key):
+    # Apply the cart editor's batched changes: edited quantities and deleted lines.
+    # Returns False if an edit was rejected for lack of stock.
+    inventory_df = current_inventory()
+    changes = st.session_state.get(editor_key) or {"edited_rows": {}, "deleted_rows": []}
+    cart = st.session_state.cart
+    applied = True
+    for row, edits in changes["edited_rows"].items():
+        line = cart[int(row)]
+        qty = edits.get("qty", line["qty"]) or 0
+        if line["barcode"] in inventory_df.index:
+            current_stock = inventory_df.at[line["barcode"], "stock_qty"]
+            if qty > current_stock:
+                st.warning(f"Not enough stock for {inventory_df.at[line['barcode'], 'name']}. Available: {current_stock}")
+                applied = False
+                continue
+        line["qty"] = qty
+
+    deleted_rows = set(changes["deleted_rows"])
+    st.session_state.cart = [line for i, line in enumerate(cart) if i not in deleted_rows and line["qty"] > 0]
+    # New editor key so the applied changes aren't replayed against the updated cart
+    st.session_state.cart_version += 1
+    return applied
+
+def line_totals(details):
+    # Per-line totals with the cart discount spread over the lines in proportion to their value
+    totals = details["unit_price"].to_numpy(dtype=np.float64) * details["qty"].to_numpy(dtype=np.int64)
+    discount_applied = st.session_state.discount
     if st.session_state.discount_type == "percent":
-        discount_amount = (st.session_state.discount / 100) * subtotal
+        totals *= 1 - discount_applied / 100
     else:
-        discount_amount = st.session_state.discount
+        subtotal = totals.sum()
+        if subtotal > 0:
+            totals -= totals * (discount_applied / subtotal)
+    return totals
+
+def calc_totals(details):
+    # The total is the sum of the same discounted line totals that checkout records
+    prices = details["unit_price"].to_numpy(dtype=np.float64)
+    qtys = details["qty"].to_numpy(dtype=np.int64)
+    subtotal = np.nansum(prices * qtys)
+    total = np.nansum(line_totals(details))
+    return subtotal, subtotal - total, total
+
+def commit_cart(cart, member_id):
+    # Validate, record the sale and deduct stock from a single cart-details frame
+    details = cart_details(cart)
 
-    total = subtotal - discount_amount
-    return subtotal, discount_amount, total
-
-def save_sale(cart, member_id):
-    sale_id = str(uuid.uuid4())
-    ts = datetime.now().isoformat(timespec="seconds")
-    discount_applied = st.session_state.discount
-
-    with open(SALES_FILE, "a", newline="") as f:
-        writer = csv.writer(f)
-        for line in cart:
-            line_total = line["unit_price"] * line["qty"]
-            if st.session_state.discount_type == "percent" and discount_applied > 0:
-                line_total -= (line_total * discount_applied / 100)
-            elif st.session_state.discount_type == "fixed":
-                cart_total = sum(l["unit_price"] * l["qty"] for l in cart)
-                if cart_total > 0:
-                    discount_share = (line_total / cart_total) * discount_applied
-                    line_total -= discount_share
-            writer.writerow([
-                sale_id, ts, member_id, line["barcode"], line["name"],
-                line["category"], line["qty"], line["unit_price"],
-                round(line_total, 2), discount_applied
-            ])
-
-def update_inventory_after_checkout(cart):
-    global inventory_df, PRODUCTS
-    for line in cart:
-        barcode = line["barcode"]
-        qty_sold = line["qty"]
-        # Find the row index for this barcode
-        idx = inventory_df.index[inventory_df["barcode"] == barcode].tolist()
-        if not idx:
-            continue  # Not found, skip
-        idx = idx[0]
-        current_stock = inventory_df.at[idx, "stock_qty"]
-        new_stock = max(current_stock - qty_sold, 0)
-        inventory_df.at[idx, "stock_qty"] = new_stock
-        # Update PRODUCTS dict as well for consistency
-        PRODUCTS[barcode]["stock_qty"] = new_stock
-
-    # Save inventory back to Excel file
-    try:
-        inventory_df.to_excel(INVENTORY_FILE, index=False)
-    except Exception as e:
-        st.error(f"Failed to save updated inventory: {e}")
+    # Check stock again before checkout (just in case)
+    missing = details["name"].isna()
+    if missing.any():
+        st.error(f"Product {details.loc[missing, 'barcode'].iloc[0]} not found in inventory at checkout.")
+        return False
+    short = details["qty"] > details["stock_qty"]
+    if short.any():
+        st.error(f"Insufficient stock for {details.loc[short, 'name'].iloc[0]} at checkout. Please adjust quantity.")
+        return False
+
+    # Build the sale rows column-wise from the cart frame and append them in one write
+    sales_df = pd.DataFrame({
+        "sale_id": str(uuid.uuid4()), "timestamp": pd.Timestamp.now().floor("s"),
+        "membership_id": member_id or None, "barcode": details["barcode"], "product_name": details["name"],
+        "category": details["category"].astype(str), "qty": details["qty"],
+        "unit_price": details["unit_price"], "line_total": line_totals(details).round(2),
+        "discount": st.session_state.discount,
+    })
+    append_sales(sales_df)
+
+    # Deduct the sold quantities and remember them until flushed; the lock keeps concurrent
+    # checkouts from overwriting each other's deductions
+    with till_state.lock:
+        state = inventory_state()
+        deduct_stock(state["df"], details["barcode"], details["qty"])
+        for barcode, qty in zip(details["barcode"], details["qty"]):
+            state["pending"][barcode] = state["pending"].get(barcode, 0) + int(qty)
+    flush_inventory()
+    schedule_flush()
+    return True
 
 def checkout():
     cart_copy = st.session_state.cart.copy()
     member_id = st.session_state.member_id
 
-    # Check stock again before checkout (just in case)
-    for line in cart_copy:
-        product = PRODUCTS.get(line["barcode"])
-        if product is None:
-            st.error(f"Product {line['name']} not found in inventory at checkout.")
-            return
-        if line["qty"] > product.get("stock_qty", 0):
-            st.error(f"Insufficient stock for {line['name']} at checkout. Please adjust quantity.")
-            return
-
-    save_sale(cart_copy, member_id)
-    update_inventory_after_checkout(cart_copy)
+    if not commit_cart(cart_copy, member_id):
+        return
 
     st.session_state.cart = []
     st.session_state.member_id = ""
     st.session_state.discount = 0
     st.success(f"✅ Sale saved at {datetime.now().strftime('%H:%M:%S')} (Member: {member_id or 'N/A'})")
 
+def checkout_cart_form(editor_key):
+    # Checkout also submits the cart form, so edits not yet applied with "Update cart" are applied
+    # first and the sale is recorded at the quantities shown in the editor
+    if not apply_cart_edits(editor_key) or not st.session_state.cart:
+        return
+    checkout()
+
+def read_recent_sales(n=20):
+    # Read only the newest day partitions so the cost doesn't grow with the log
+    frames, rows = [], 0
+    for partition in sorted(os.listdir(SALES_DIR), reverse=True):
+        if not partition.startswith("date="):
+            continue
+        frames.append(pd.read_parquet(os.path.join(SALES_DIR, partition)))
+        rows += len(frames[-1])
+        if rows >= n:
+            break
+    if not frames:
+        return pd.DataFrame(columns=SALES_SCHEMA.names[:-1])
+    return pd.concat(frames).sort_values("timestamp").tail(n)
+
+def sales_log_csv():
+    # Passed to st.download_button as a callable so the full log is only read when downloaded
+    return pd.read_parquet(SALES_DIR).drop(columns="date").sort_values("timestamp").to_csv(index=False)
+
+def inventory_xlsx():
+    # Likewise only built on download; the lock keeps a concurrent checkout from changing stock mid-export
+    inventory_df = current_inventory()
+    xlsx_buffer = io.BytesIO()
+    with till_state.lock:
+        inventory_df.to_excel(xlsx_buffer, index=False)
+    return xlsx_buffer.getvalue()
+
 def handle_scan():
     code = str(st.session_state.barcode_input).strip()
     try:
@@ -202,8 +399,8 @@ with col2:
     st.number_input("Qty", min_value=1, step=1, key="qty_input")
 
 # Product search
-product_names = {v['name']: k for k, v in PRODUCTS.items()}
-selected_name = st.selectbox("Search product by name", [""] + list(product_names.keys()))
+product_names, name_options = build_name_index(inventory_state()["mtime"])
+selected_name = st.selectbox("Search product by name", name_options)
 if selected_name:
     add_to_cart(product_names[selected_name])
 
@@ -221,41 +418,58 @@ else:
 # Cart Display
 st.subheader("🛒 Cart")
 if st.session_state.cart:
-    low_stock_items = []
-    for line in st.session_state.cart:
-        st.write(f"{line['qty']} × {line['name']} ({line.get('pack_size','')}) @ R{line['unit_price']:.2f}")
+    details = cart_details(st.session_state.cart)
+
+    # Quantity edits and removals are batched into one rerun when the form is submitted; products
+    # only enter the cart by scan or search, so the editor allows deleting lines but not adding them
+    editor_key = f"cart_editor_{st.session_state.cart_version}"
+    with st.form("cart_form"):
+        st.data_editor(
+            details[["name", "pack_size", "unit_price", "qty"]],
+            key=editor_key,
+            num_rows="delete",
+            hide_index=True,
+            disabled=["name", "pack_size", "unit_price"],
+            column_config={
+                "name": "Product",
+                "pack_size": "Pack size",
+                "unit_price": st.column_config.NumberColumn("Price", format="R%.2f"),
+                "qty": st.column_config.NumberColumn("Qty", min_value=0, step=1),
+            },
+        )
 
         # Reorder warning if stock after sale <= reorder_level
-        product = PRODUCTS.get(line["barcode"])
-        if product:
-            remaining_stock = product.get("stock_qty", 0) - line["qty"]
-            reorder_level = product.get("reorder_level", 10)
-            if remaining_stock <= reorder_level:
-                low_stock_items.append(f"{line['name']} (Remaining: {remaining_stock})")
-
-        st.button(f"Remove 1 ({line['name']})", key=f"remove_{line['id']}", on_click=remove_one_from_cart, args=(line['id'],))
-
-    if low_stock_items:
-        st.warning("⚠️ Reorder warning for: " + ", ".join(low_stock_items))
-
-    subtotal, discount_amount, total = calc_totals()
-    st.markdown(f"**Subtotal: R{subtotal:.2f}**")
-    if discount_amount:
-        st.markdown(f"**Discount: -R{discount_amount:.2f}**")
-    st.markdown(f"### Total: R{total:.2f}")
-
-    st.button("✅ Checkout", on_click=checkout)
+        remaining_stock = details["stock_qty"] - details["qty"]
+        low_stock = remaining_stock <= details["reorder_level"]
+        low_stock_items = [
+            f"{name} (Remaining: {remaining})"
+            for name, remaining in zip(details.loc[low_stock, "name"], remaining_stock[low_stock])
+        ]
+        if low_stock_items:
+            st.warning("⚠️ Reorder warning for: " + ", ".join(low_stock_items))
+
+        subtotal, discount_amount, total = calc_totals(details)
+        st.markdown(f"**Subtotal: R{subtotal:.2f}**")
+        if discount_amount:
+            st.markdown(f"**Discount: -R{discount_amount:.2f}**")
+        st.markdown(f"### Total: R{total:.2f}")
+
+        update_col, checkout_col = st.columns(2)
+        with update_col:
+            st.form_submit_button("Update cart", on_click=apply_cart_edits, args=(editor_key,))
+        with checkout_col:
+            st.form_submit_button("✅ Checkout", on_click=checkout_cart_form, args=(editor_key,))
 else:
     st.info("Cart is empty.")
 
 # Optional Views
 if st.checkbox("📦 Show Inventory"):
     st.dataframe(inventory_df)
+    st.download_button("Download Inventory (Excel)", data=inventory_xlsx, file_name="inventory.xlsx")
 
 if st.checkbox("📄 Show Recent Sales"):
     try:
-        sales_log_df = pd.read_csv(SALES_FILE)
-        st.dataframe(sales_log_df.tail(20))
-        st.download_button("Download Sales Log", data=sales_log_df.to_csv(index=False), file_name="sales_log.csv")
+        st.dataframe(read_recent_sales(20))
+        st.download_button("Download Sales Log", data=sales_log_csv, file_name="sales_log.csv")
     except Exception as e:
         st.error(f"Error reading sales log: {e}")
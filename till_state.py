@@ -0,0 +1,16 @@
+"""Process-wide state for the till.
+
+Streamlit re-executes till.py on every rerun and its caches can be cleared from the
+app menu, so anything that must survive for the life of the server (the live
+inventory with stock changes not yet written to disk) lives in this ordinary
+imported module instead.
+"""
+import threading
+
+# Guards the live inventories and one-off file migrations across sessions (threads)
+lock = threading.RLock()
+
+# Per inventory file: {"df": live barcode-indexed frame, "mtime": file mtime it matches,
+#                      "pending": {barcode: qty sold, not yet written}, "last_flush": float,
+#                      "timer": threading.Timer armed while sales are pending, or None}
+inventories = {}